@@ -1,7 +1,14 @@
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError as JWTError
+from cachetools import TTLCache
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import bcrypt
+import hashlib
+import os
+import time
 from fastapi import HTTPException, status, Depends, Request, Cookie
 from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -10,18 +17,92 @@ from models import User
 from database import get_db
 
 # Security configuration
-SECRET_KEY = "your-secret-key-keep-it-secret"  # Change this in production!
+# Read once at import as bytes so the HMAC key isn't re-encoded per token
+_secret_key = os.getenv("GRILLZ_SECRET_KEY")
+if not _secret_key:
+    raise RuntimeError("GRILLZ_SECRET_KEY environment variable is not set")
+SECRET_KEY = _secret_key.encode()
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Tune BCRYPT_ROUNDS so a single verify takes ~250ms on the production hardware.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "10"))
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+# bcrypt is CPU-bound; run it off the event loop so logins don't stall other
+# requests. The bcrypt package releases the GIL while hashing, so
+# PASSWORD_HASH_EXECUTOR=thread avoids the worker processes' pickling and
+# memory overhead while still spreading across cores.
+PASSWORD_HASH_EXECUTOR = os.environ.get("PASSWORD_HASH_EXECUTOR", "process")
+# Built on first use and reset on shutdown, so a later app lifespan in the
+# same process gets a fresh pool
+_bcrypt_pool = None
+
+def _get_bcrypt_pool():
+    global _bcrypt_pool
+    if _bcrypt_pool is None:
+        if PASSWORD_HASH_EXECUTOR == "thread":
+            _bcrypt_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+        else:
+            _bcrypt_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _bcrypt_pool
+
+# Decoded JWT payloads keyed by SHA-256 of the raw token, so repeated requests
+# with the same cookie skip signature verification
+_token_cache = TTLCache(maxsize=10000, ttl=30)
+# Tokens that failed verification or expired; a stale cookie stays bad, so
+# repeat requests can be rejected without decoding again
+_bad_token_cache = TTLCache(maxsize=5000, ttl=60)
+# Resolved users keyed by email so authenticated requests skip the users
+# lookup; call invalidate_cached_user whenever a user row changes. The cache
+# is per process, so invalidation only reaches the worker that made the
+# change; the short TTL bounds how long other workers can serve a stale
+# is_admin/is_active
+_user_cache = TTLCache(maxsize=10000, ttl=5)
+
+def invalidate_cached_user(email: str):
+    _user_cache.pop(email, None)
+
+def _bcrypt_rounds(hashed_password: str) -> int:
+    return int(hashed_password[4:6])
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    if not hashed_password:
+        return False
+    if hashed_password.startswith(BCRYPT_PREFIXES):
+        try:
+            return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+        except ValueError:
+            return False
+    return False
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password and return a replacement hash if the stored one is outdated"""
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if _bcrypt_rounds(hashed_password) == BCRYPT_ROUNDS:
+        return True, None
+    return True, get_password_hash(plain_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+async def verify_and_update_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_bcrypt_pool(), verify_and_update_password, plain_password, hashed_password
+    )
+
+async def get_password_hash_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_bcrypt_pool(), get_password_hash, password
+    )
+
+def shutdown_password_pool():
+    global _bcrypt_pool
+    if _bcrypt_pool is not None:
+        _bcrypt_pool.shutdown(wait=False, cancel_futures=True)
+        _bcrypt_pool = None
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
@@ -39,18 +120,34 @@ async def get_current_user(
     )
     if not auth_token:
         raise credentials_exception
+    token_key = hashlib.sha256(auth_token.encode()).digest()
+    if token_key in _bad_token_cache:
+        raise credentials_exception
+    payload = _token_cache.get(token_key)
+    # Cached payloads must still respect the token's own expiry
+    if payload is not None and payload.get("exp", 0) <= time.time():
+        _token_cache.pop(token_key, None)
+        _bad_token_cache[token_key] = True
+        raise credentials_exception
     try:
-        payload = jwt.decode(auth_token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload is None:
+            payload = jwt.decode(auth_token, SECRET_KEY, algorithms=[ALGORITHM])
+            _token_cache[token_key] = payload
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
     except JWTError:
+        _bad_token_cache[token_key] = True
         raise credentials_exception
-    async with db as session:
-        result = await session.execute(select(User).where(User.email == email))
-        user = result.scalar_one_or_none()
+    user = _user_cache.get(email)
     if user is None:
-        raise credentials_exception
+        result = await db.execute(select(User).where(User.email == email))
+        user = result.scalar_one_or_none()
+        if user is None:
+            raise credentials_exception
+        # Detach so the cached instance isn't tied to this request's session
+        db.expunge(user)
+        _user_cache[email] = user
     return user
 
 # Optional dependency for routes that can be accessed by both authenticated and anonymous users
@@ -88,4 +185,16 @@ async def get_current_user_or_redirect(
                 status_code=status.HTTP_303_SEE_OTHER,
                 detail="Redirecting to login",
                 headers={"Location": "/auth/login"}
-            ) 
\ No newline at end of file
+            ) 
+
+# Dependency for HTML pages that need a signed-in, active user
+async def require_active_user_or_redirect(
+    current_user: Optional[User] = Depends(get_optional_current_user)
+) -> User:
+    if current_user is None or not current_user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_303_SEE_OTHER,
+            detail="Redirecting to login",
+            headers={"Location": "/auth/login"}
+        )
+    return current_user
@@ -1,7 +1,10 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event
 from models import Base
 from pathlib import Path
+import os
 
 # Get the current directory
 current_dir = Path(__file__).parent
@@ -9,13 +12,38 @@ current_dir = Path(__file__).parent
 # SQLite database URL with absolute path
 SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///{current_dir}/grillz.db"
 
+# Keep connections open between requests; an in-memory database would be
+# lost when its connection is recycled, so only pool file-backed databases
+pool_options = {}
+if ":memory:" not in SQLALCHEMY_DATABASE_URL:
+    pool_options = {
+        "poolclass": AsyncAdaptedQueuePool,
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_recycle": 1800,
+        # Local SQLite connections don't drop like network ones, so checking
+        # each connection on checkout is opt-in (DB_POOL_PRE_PING=1)
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "0") == "1",
+    }
+
 # Create async engine
 engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    echo=True  # Log SQL for debugging
+    echo=os.environ.get("SQL_ECHO", "0") == "1",  # Set SQL_ECHO=1 to log SQL for debugging
+    **pool_options
 )
 
+# Apply SQLite tuning once per new connection
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 # Create async session factory
 AsyncSessionLocal = sessionmaker(
     bind=engine,
@@ -33,8 +61,6 @@ async def get_db():
         except Exception:
             await session.rollback()
             raise
-        finally:
-            await session.close()
 
 # Create tables
 async def create_tables():
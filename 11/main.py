@@ -1,29 +1,47 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import functools
+import logging
 import os
+import queue
+import stat
+from mimetypes import guess_type
 from pathlib import Path
+import anyio
 from dotenv import load_dotenv
+from logging.handlers import QueueHandler, QueueListener
+from starlette.datastructures import Headers
 from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
 
 # Load environment variables from .env file (if present)
 load_dotenv()
 
+# Setup logging: request handlers only enqueue records, and a background
+# thread writes them out so log I/O never blocks the event loop
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+_log_listener_started = False
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+
 # Import database and models
 from database import create_tables
+from auth import shutdown_password_pool
 
 # Create FastAPI app WITHOUT docs
 app = FastAPI(
     title="Grillz Studio",
     docs_url=None,  # Disable /docs
     redoc_url=None,  # Disable /redoc
-    openapi_url=None  # Disable /openapi.json
+    openapi_url=None,  # Disable /openapi.json
+    default_response_class=ORJSONResponse  # Faster JSON encoding for API responses
 )
 
-# Add gzip compression for responses larger than 500 bytes
-app.add_middleware(GZipMiddleware, minimum_size=500)
+# Add gzip compression for responses larger than 1 KB
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 # CORS middleware - RESTRICTED for production
 app.add_middleware(
@@ -34,11 +52,71 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization"],  # Only allow necessary headers
 )
 
+# Cache static assets in the browser for 1 year
+STATIC_CACHE_CONTROL = (b"cache-control", b"public, max-age=31536000, immutable")
+
+# Assets that may have a .gz sibling built by precompress_static.py
+PRECOMPRESSED_SUFFIXES = (".js", ".css", ".svg")
+
+@functools.lru_cache(maxsize=None)
+def resolve_static_directory(directory: str) -> str:
+    """Resolve a static root directory once; it doesn't move while the app runs"""
+    return os.path.realpath(directory)
+
 class CachedStaticFiles(StaticFiles):
+    def lookup_path(self, path):
+        # Same as StaticFiles.lookup_path, but each static root's realpath is
+        # memoized. The requested path is still resolved on every call, so a
+        # file later replaced by a symlink out of the root is rejected
+        if self.follow_symlink:
+            return super().lookup_path(path)
+        for directory in self.all_directories:
+            directory = resolve_static_directory(str(directory))
+            full_path = os.path.realpath(os.path.join(directory, path))
+            if os.path.commonpath([full_path, directory]) != directory:
+                continue
+            try:
+                return full_path, os.stat(full_path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return "", None
+
     async def get_response(self, path, request):
-        response = await super().get_response(path, request)
-        # Cache static assets in the browser for 1 year
-        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        response = await self.get_precompressed_response(path, request)
+        if response is None:
+            response = await super().get_response(path, request)
+        # StaticFiles never sets Cache-Control, so append the raw header
+        # instead of going through the case-insensitive header lookup
+        response.raw_headers.append(STATIC_CACHE_CONTROL)
+        return response
+
+    async def get_precompressed_response(self, path, scope):
+        """Serve the pre-built .gz file when the client accepts gzip"""
+        request_headers = Headers(scope=scope)
+        if (
+            scope["method"] not in ("GET", "HEAD")
+            or not path.endswith(PRECOMPRESSED_SUFFIXES)
+            or "gzip" not in request_headers.get("accept-encoding", "")
+        ):
+            return None
+        (full_path, stat_result), (_, source_stat) = await anyio.to_thread.run_sync(
+            lambda: (self.lookup_path(path + ".gz"), self.lookup_path(path))
+        )
+        if not stat_result or not stat.S_ISREG(stat_result.st_mode):
+            return None
+        # A .gz older than its source is stale (the asset was edited without
+        # re-running precompress_static.py), so fall back to the source file
+        if source_stat is not None and stat_result.st_mtime < source_stat.st_mtime:
+            return None
+        # GZipMiddleware leaves responses that already carry Content-Encoding alone
+        response = FileResponse(
+            full_path,
+            stat_result=stat_result,
+            media_type=guess_type(path)[0],
+            headers={"content-encoding": "gzip", "vary": "Accept-Encoding"}
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
         return response
 
 # Mount static files
@@ -47,7 +125,7 @@ static_path.mkdir(exist_ok=True)
 app.mount("/static", CachedStaticFiles(directory=str(static_path)), name="static")
 
 # Templates
-templates = Jinja2Templates(directory="templates")
+from templating import JINJA_CACHE_DIR, warm_templates
 
 # Import routers after app creation
 from routes import auth, orders, pages, referrals, admin
@@ -62,18 +140,34 @@ app.include_router(admin.router)
 # Error handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
-        content={"detail": exc.detail}
+        content={"detail": exc.detail},
+        headers=exc.headers
     )
 
 # Startup event to create database tables
 @app.on_event("startup")
 async def startup_event():
+    global _log_listener_started
+    if not _log_listener_started:
+        log_listener.start()
+        _log_listener_started = True
+    if JINJA_CACHE_DIR:
+        os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+    warm_templates()
     print("Creating database tables...")
     await create_tables()
     print("Database tables created!")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    global _log_listener_started
+    shutdown_password_pool()
+    if _log_listener_started:
+        log_listener.stop()
+        _log_listener_started = False
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
@@ -1,4 +1,5 @@
 import asyncio
+import sys
 from sqlalchemy import text
 from database import engine
 from models import Base
@@ -12,5 +13,16 @@ async def migrate_database():
         await conn.run_sync(Base.metadata.create_all)
         print("Database migration completed successfully!")
 
+async def create_indexes():
+    """Add missing indexes to an existing database without dropping data"""
+    async with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+        print("Indexes created successfully!")
+
 if __name__ == "__main__":
-    asyncio.run(migrate_database()) 
\ No newline at end of file
+    if sys.argv[1:] == ["indexes"]:
+        asyncio.run(create_indexes())
+    else:
+        asyncio.run(migrate_database()) 
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, JSON, Text
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, JSON, Text, Index
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.dialects.postgresql import UUID
 from datetime import datetime
@@ -43,6 +43,13 @@ class Order(Base):
     
     user = relationship("User", back_populates="orders")
     invoice = relationship("Invoice", back_populates="order", uselist=False)
+    
+    __table_args__ = (
+        Index("ix_orders_user_status", "user_id", "payment_status"),
+        Index("ix_orders_user_created", "user_id", "created_at"),  # User order lists sorted by date
+        Index("ix_orders_status_created", "payment_status", "created_at"),  # Revenue analytics range scans
+        Index("ix_orders_created_at", "created_at"),
+    )
 
 class Invoice(Base):
     __tablename__ = "invoices"
@@ -72,7 +79,7 @@ class ReferralCode(Base):
     
     id = Column(Integer, primary_key=True)
     code = Column(String, unique=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="referral_code")
@@ -92,4 +99,28 @@ class ReferralUse(Base):
     
     referral_code = relationship("ReferralCode", back_populates="uses")
     referred_user = relationship("User", foreign_keys=[referred_user_id])
-    first_order = relationship("Order", foreign_keys=[first_order_id]) 
\ No newline at end of file
+    first_order = relationship("Order", foreign_keys=[first_order_id])
+    
+    # Partial indexes over unused discounts only; queries must filter with
+    # .is_(False) so the planner can match the index predicate
+    __table_args__ = (
+        Index(
+            "ix_referral_uses_pending_referee",
+            "referred_user_id",
+            sqlite_where=referee_discount_used.is_(False),
+            postgresql_where=referee_discount_used.is_(False)
+        ),
+        Index(
+            "ix_referral_uses_pending_referrer",
+            "referral_code_id",
+            sqlite_where=referrer_discount_used.is_(False),
+            postgresql_where=referrer_discount_used.is_(False)
+        ),
+        # Covers the per-code referral stats aggregate without touching rows
+        Index(
+            "ix_referral_uses_code_status",
+            "referral_code_id",
+            "is_active",
+            "referrer_discount_used"
+        ),
+    ) 
\ No newline at end of file
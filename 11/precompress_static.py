@@ -0,0 +1,20 @@
+import gzip
+import shutil
+from pathlib import Path
+
+STATIC_DIR = Path(__file__).parent / "static"
+SUFFIXES = (".js", ".css", ".svg")
+
+def precompress_static():
+    """Write a gzip -9 copy next to every static asset, run at deploy time"""
+    count = 0
+    for path in STATIC_DIR.rglob("*"):
+        if not path.is_file() or path.suffix not in SUFFIXES:
+            continue
+        with path.open("rb") as src, gzip.open(f"{path}.gz", "wb", compresslevel=9) as dst:
+            shutil.copyfileobj(src, dst)
+        count += 1
+    print(f"Pre-compressed {count} static files!")
+
+if __name__ == "__main__":
+    precompress_static()
@@ -1,19 +1,26 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, case
 from typing import List, Optional
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
 import calendar
 
 from database import get_db
 from models import User, Order, ReferralCode, ReferralUse
-from auth import get_optional_current_user
+from auth import get_optional_current_user, invalidate_cached_user
+from templating import templates
 
 router = APIRouter(prefix="/admin", tags=["admin"])
-templates = Jinja2Templates(directory="templates")
+
+# Dashboard aggregates change slowly; serve repeated polls from memory
+_stats_cache = TTLCache(maxsize=4, ttl=30)
+
+_VALID_ORDER_STATUSES = frozenset({"pending", "paid", "shipped", "failed", "cancelled"})
+# Orders that count towards revenue
+_REVENUE_STATUSES = ("paid", "shipped")
 
 # Security dependency - admin only
 async def require_admin(
@@ -30,7 +37,6 @@ async def require_admin(
             )
         else:
             # For HTML pages, redirect to login
-            from fastapi.responses import RedirectResponse
             raise HTTPException(
                 status_code=status.HTTP_303_SEE_OTHER,
                 detail="Redirecting to login",
@@ -138,58 +144,52 @@ async def get_admin_stats(
 ):
     """Get overall admin statistics"""
     
+    if "stats" in _stats_cache:
+        return _stats_cache["stats"]
+    
     try:
         # Get user stats
         users_result = await db.execute(select(func.count(User.id)))
         total_users = users_result.scalar() or 0
         
-        # Get order stats
-        orders_result = await db.execute(select(func.count(Order.id)))
-        total_orders = orders_result.scalar() or 0
-        
-        pending_result = await db.execute(
-            select(func.count(Order.id)).where(Order.payment_status == 'pending')
-        )
-        pending_orders = pending_result.scalar() or 0
-        
-        completed_result = await db.execute(
-            select(func.count(Order.id)).where(Order.payment_status == 'paid')
-        )
-        completed_orders = completed_result.scalar() or 0
-        
-        shipped_result = await db.execute(
-            select(func.count(Order.id)).where(Order.payment_status == 'shipped')
-        )
-        shipped_orders = shipped_result.scalar() or 0
-        
-        failed_result = await db.execute(
-            select(func.count(Order.id)).where(Order.payment_status == 'failed')
-        )
-        failed_orders = failed_result.scalar() or 0
-        
-        # Get revenue (from paid and shipped orders)
-        revenue_result = await db.execute(
-            select(func.sum(Order.total_price)).where(
-                Order.payment_status.in_(['paid', 'shipped'])
+        # Get order counts per status and revenue (from paid and shipped orders) in one pass
+        orders_result = await db.execute(
+            select(
+                func.count(Order.id).label("total"),
+                func.sum(case((Order.payment_status == 'pending', 1), else_=0)).label("pending"),
+                func.sum(case((Order.payment_status == 'paid', 1), else_=0)).label("paid"),
+                func.sum(case((Order.payment_status == 'shipped', 1), else_=0)).label("shipped"),
+                func.sum(case((Order.payment_status == 'failed', 1), else_=0)).label("failed"),
+                func.sum(
+                    case((Order.payment_status.in_(_REVENUE_STATUSES), Order.total_price), else_=0)
+                ).label("revenue")
             )
         )
-        total_revenue = revenue_result.scalar() or 0.0
+        order_stats = orders_result.one()
+        total_orders = order_stats.total or 0
+        pending_orders = order_stats.pending or 0
+        completed_orders = order_stats.paid or 0
+        shipped_orders = order_stats.shipped or 0
+        failed_orders = order_stats.failed or 0
+        total_revenue = order_stats.revenue or 0.0
         
         # Get referral stats - handle case where ReferralUse table might not exist or be empty
         try:
-            referrals_result = await db.execute(select(func.count(ReferralUse.id)))
-            total_referrals = referrals_result.scalar() or 0
-            
-            active_referrals_result = await db.execute(
-                select(func.count(ReferralUse.id)).where(ReferralUse.is_active == True)
+            referrals_result = await db.execute(
+                select(
+                    func.count(ReferralUse.id),
+                    func.sum(case((ReferralUse.is_active == True, 1), else_=0))
+                )
             )
-            active_referrals = active_referrals_result.scalar() or 0
+            total_referrals, active_referrals = referrals_result.one()
+            total_referrals = total_referrals or 0
+            active_referrals = active_referrals or 0
         except Exception:
             # If referral tables don't exist or have issues, default to 0
             total_referrals = 0
             active_referrals = 0
         
-        return AdminStats(
+        stats = AdminStats(
             total_users=total_users,
             total_orders=total_orders,
             total_revenue=total_revenue,
@@ -200,6 +200,8 @@ async def get_admin_stats(
             total_referrals=total_referrals,
             active_referrals=active_referrals
         )
+        _stats_cache["stats"] = stats
+        return stats
     except Exception as e:
         print(f"Error in get_admin_stats: {str(e)}")
         raise HTTPException(
@@ -254,37 +256,42 @@ async def get_all_users(
     """Get all users with their order statistics"""
     
     try:
-        # Get all users first
-        users_query = select(User).order_by(User.created_at.desc()).limit(limit).offset(offset)
+        # Get users with their order count and total spent (paid and shipped orders) in one query
+        users_query = (
+            select(
+                User.id,
+                User.email,
+                User.full_name,
+                User.is_admin,
+                User.created_at,
+                func.count(Order.id).label("total_orders"),
+                func.coalesce(
+                    func.sum(
+                        case((Order.payment_status.in_(_REVENUE_STATUSES), Order.total_price), else_=0)
+                    ),
+                    0
+                ).label("total_spent")
+            )
+            .outerjoin(Order, Order.user_id == User.id)
+            .group_by(User.id)
+            .order_by(User.created_at.desc())
+            .limit(limit)
+            .offset(offset)
+        )
         users_result = await db.execute(users_query)
-        users = users_result.scalars().all()
         
-        # Build response with basic user data and simple stats
-        user_summaries = []
-        for user in users:
-            # Get order count for this user
-            orders_count_query = select(func.count(Order.id)).where(Order.user_id == user.id)
-            orders_count_result = await db.execute(orders_count_query)
-            total_orders = orders_count_result.scalar() or 0
-            
-            # Get total spent for this user (paid and shipped orders)
-            total_spent_query = select(func.sum(Order.total_price)).where(
-                and_(Order.user_id == user.id, Order.payment_status.in_(['paid', 'shipped']))
+        return [
+            UserSummary(
+                id=row.id,
+                email=row.email,
+                full_name=row.full_name,
+                is_admin=row.is_admin,
+                created_at=row.created_at,
+                total_orders=row.total_orders,
+                total_spent=float(row.total_spent)
             )
-            total_spent_result = await db.execute(total_spent_query)
-            total_spent = total_spent_result.scalar() or 0.0
-            
-            user_summaries.append(UserSummary(
-                id=user.id,
-                email=user.email,
-                full_name=user.full_name,
-                is_admin=user.is_admin,
-                created_at=user.created_at,
-                total_orders=total_orders,
-                total_spent=float(total_spent)
-            ))
-        
-        return user_summaries
+            for row in users_result.all()
+        ]
     except Exception as e:
         print(f"Error in get_all_users: {str(e)}")
         raise HTTPException(
@@ -321,6 +328,7 @@ async def toggle_user_admin(
         # Toggle admin status
         target_user.is_admin = not target_user.is_admin
         await db.commit()
+        invalidate_cached_user(target_user.email)
         
         return {
             "success": True,
@@ -346,9 +354,14 @@ async def get_revenue_analytics(
 ):
     """Get revenue analytics data"""
     
+    if "revenue" in _stats_cache:
+        return _stats_cache["revenue"]
+    
+    now = datetime.utcnow()
+    
     # Get daily revenue for last 30 days
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    daily_result = await db.execute(
+    thirty_days_ago = now - timedelta(days=30)
+    daily_query = (
         select(
             func.date(Order.created_at).label('date'),
             func.sum(Order.total_price).label('revenue')
@@ -362,17 +375,13 @@ async def get_revenue_analytics(
         .group_by(func.date(Order.created_at))
         .order_by(func.date(Order.created_at))
     )
-    daily_revenue = [
-        {"date": str(date), "revenue": float(revenue)}
-        for date, revenue in daily_result.all()
-    ]
     
-    # Get monthly revenue for last 12 months
-    twelve_months_ago = datetime.utcnow() - timedelta(days=365)
-    monthly_result = await db.execute(
+    # Get monthly revenue for last 12 months, grouped by SQLite's 'YYYY-MM' strftime
+    twelve_months_ago = now - timedelta(days=365)
+    year_month = func.strftime('%Y-%m', Order.created_at)
+    monthly_query = (
         select(
-            func.extract('year', Order.created_at).label('year'),
-            func.extract('month', Order.created_at).label('month'),
+            year_month.label('ym'),
             func.sum(Order.total_price).label('revenue')
         )
         .where(
@@ -381,25 +390,12 @@ async def get_revenue_analytics(
                 Order.created_at >= twelve_months_ago
             )
         )
-        .group_by(
-            func.extract('year', Order.created_at),
-            func.extract('month', Order.created_at)
-        )
-        .order_by(
-            func.extract('year', Order.created_at),
-            func.extract('month', Order.created_at)
-        )
+        .group_by(year_month)
+        .order_by(year_month)
     )
-    monthly_revenue = [
-        {
-            "month": f"{calendar.month_abbr[int(month)]} {int(year)}",
-            "revenue": float(revenue)
-        }
-        for year, month, revenue in monthly_result.all()
-    ]
     
     # Get top materials by revenue
-    materials_result = await db.execute(
+    materials_query = (
         select(
             Order.material,
             func.sum(Order.total_price).label('revenue'),
@@ -409,20 +405,42 @@ async def get_revenue_analytics(
         .group_by(Order.material)
         .order_by(func.sum(Order.total_price).desc())
     )
+    
+    # Run on the request session rather than gathering over extra pooled
+    # sessions, which would hold four connections per admin request
+    daily_rows = (await db.execute(daily_query)).all()
+    monthly_rows = (await db.execute(monthly_query)).all()
+    material_rows = (await db.execute(materials_query)).all()
+    
+    daily_revenue = [
+        {"date": str(date), "revenue": float(revenue)}
+        for date, revenue in daily_rows
+    ]
+    
+    monthly_revenue = []
+    for ym, revenue in monthly_rows:
+        year, month = ym.split('-')
+        monthly_revenue.append({
+            "month": f"{calendar.month_abbr[int(month)]} {year}",
+            "revenue": float(revenue)
+        })
+    
     top_materials = [
         {
             "material": material,
             "revenue": float(revenue),
             "count": count
         }
-        for material, revenue, count in materials_result.all()
+        for material, revenue, count in material_rows
     ]
     
-    return RevenueData(
+    revenue_data = RevenueData(
         daily_revenue=daily_revenue,
         monthly_revenue=monthly_revenue,
         top_materials=top_materials
     )
+    _stats_cache["revenue"] = revenue_data
+    return revenue_data
 
 
 @router.put("/api/orders/{order_id}/status")
@@ -435,7 +453,7 @@ async def update_order_status(
     """Update order status manually"""
     
     try:
-        if status_update.status not in ['pending', 'paid', 'shipped', 'failed', 'cancelled']:
+        if status_update.status not in _VALID_ORDER_STATUSES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, 
                 detail="Invalid status. Must be one of: pending, paid, shipped, failed, cancelled"
@@ -453,9 +471,10 @@ async def update_order_status(
         
         old_status = order.payment_status
         order.payment_status = status_update.status
-        order.updated_at = datetime.utcnow()
+        order.updated_at = datetime.now(timezone.utc)
         
         await db.commit()
+        _stats_cache.clear()
         
         return {
             "success": True,
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Response
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, exists
 from datetime import timedelta
 from typing import Optional
 from pydantic import BaseModel, EmailStr
@@ -9,12 +10,14 @@ from pydantic import BaseModel, EmailStr
 from database import get_db
 from models import User, ReferralCode, ReferralUse
 from auth import (
-    verify_password,
+    verify_and_update_password_async,
     create_access_token,
-    get_password_hash,
+    get_password_hash_async,
     get_current_user,
+    invalidate_cached_user,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from routes.pages import generate_secure_referral_code
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -45,11 +48,22 @@ async def login(
 ):
     result = await db.execute(select(User).where(User.email == user_data.email))
     user = result.scalar_one_or_none()
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
+    verified, new_hash = await verify_and_update_password_async(user_data.password, user.hashed_password)
+    if not verified:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password"
+        )
+    # Lazily migrate hashes created with an old scheme or cost factor
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
+        invalidate_cached_user(user.email)
     access_token = create_access_token(
         data={"sub": user.email},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -65,21 +79,21 @@ async def login(
 
 @router.post("/register", response_model=UserResponse)
 async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User).where(User.email == user_data.email))
-    if result.scalar_one_or_none():
+    result = await db.execute(select(exists().where(User.email == user_data.email)))
+    if result.scalar():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
 
     # Handle referral code if provided
-    referral_code = None
+    referral_code_id = None
     if user_data.referral_code:
         result = await db.execute(
-            select(ReferralCode).where(ReferralCode.code == user_data.referral_code)
+            select(ReferralCode.id).where(ReferralCode.code == user_data.referral_code)
         )
-        referral_code = result.scalar_one_or_none()
-        if not referral_code:
+        referral_code_id = result.scalar_one_or_none()
+        if not referral_code_id:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid referral code"
@@ -87,26 +101,25 @@ async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
 
     user = User(
         email=user_data.email,
-        hashed_password=get_password_hash(user_data.password),
+        hashed_password=await get_password_hash_async(user_data.password),
         full_name=user_data.full_name,
         referred_by=user_data.referral_code
     )
     db.add(user)
-    await db.commit()
-    await db.refresh(user)
+    # Flush to get user.id; everything below commits in the same transaction
+    await db.flush()
 
     # Create referral code for new user
-    import uuid
     new_referral = ReferralCode(
-        code=str(uuid.uuid4())[:8],
+        code=generate_secure_referral_code(8),
         user_id=user.id
     )
     db.add(new_referral)
 
     # Record referral use if code was provided
-    if referral_code:
+    if referral_code_id:
         referral_use = ReferralUse(
-            referral_code_id=referral_code.id,
+            referral_code_id=referral_code_id,
             referred_user_id=user.id
         )
         db.add(referral_use)
@@ -120,11 +133,12 @@ async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
 
 @router.get("/me", response_model=UserResponse)
 async def read_users_me(current_user: User = Depends(get_current_user)):
-    return UserResponse(
-        email=current_user.email,
-        full_name=current_user.full_name,
-        is_admin=current_user.is_admin
-    )
+    # Trusted values from the user row; skip response-model re-validation
+    return ORJSONResponse(content={
+        "email": current_user.email,
+        "full_name": current_user.full_name,
+        "is_admin": current_user.is_admin
+    })
 
 @router.post("/logout")
 async def logout(response: Response):
@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import select, update, and_, or_
 from typing import List, Optional, Dict
 from pydantic import BaseModel, Field
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
 import stripe
+import asyncio
 import os
 import uuid
 import logging
@@ -16,8 +18,6 @@ from database import get_db
 from models import Order, User, Invoice, ReferralCode, ReferralUse
 from auth import get_current_user
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api", tags=["orders"])
@@ -29,6 +29,10 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
+# IDs of webhook events already handled; Stripe retries deliveries, so
+# duplicates within 24h are acknowledged without touching the database
+_processed_webhook_events = TTLCache(maxsize=10000, ttl=86400)
+
 # ---------------------------------------------------------------------------
 # Pricing Configuration
 # ---------------------------------------------------------------------------
@@ -50,6 +54,27 @@ GRILLZ_PRICES = {
     }
 }
 
+# ---------------------------------------------------------------------------
+# Stripe Checkout Templates
+# ---------------------------------------------------------------------------
+CHECKOUT_SESSION_DEFAULTS = {
+    'payment_method_types': ['card'],
+    'mode': 'payment',
+}
+
+def build_checkout_product_data(product_type: str, material: str) -> dict:
+    return {
+        'name': f'{product_type.title()} - {material.title()}',
+        'description': f'Custom {product_type} order',
+    }
+
+# Grillz materials are known up front; watches and bracelets take free-form
+# materials and are built per order
+CHECKOUT_PRODUCT_DATA = {
+    ('grillz', material): build_checkout_product_data('grillz', material)
+    for material in GRILLZ_PRICES
+}
+
 # ---------------------------------------------------------------------------
 # Pydantic Models
 # ---------------------------------------------------------------------------
@@ -92,6 +117,10 @@ class OrderResponse(BaseModel):
     class Config:
         from_attributes = True
 
+# Columns returned by /orders; rows are read straight from the database, so
+# they are serialized without going through OrderResponse validation
+ORDER_RESPONSE_COLUMNS = [getattr(Order, name) for name in OrderResponse.model_fields]
+
 class CreateOrderResponse(BaseModel):
     success: bool
     order_uuid: str
@@ -110,6 +139,19 @@ class InvoiceResponse(BaseModel):
     status: str
     message: str
 
+# Fixed acknowledgement bodies returned to Stripe
+WEBHOOK_ACK_JSON = b'{"status":"success"}'
+WEBHOOK_DUPLICATE_JSON = b'{"status":"duplicate"}'
+
+# Prices are fixed at startup, so serialize the pricing response once
+PRICES_JSON = PricingResponse(
+    materials={
+        material: MaterialPrice(**details)
+        for material, details in GRILLZ_PRICES.items()
+    },
+    stripe_publishable_key=STRIPE_PUBLISHABLE_KEY
+).model_dump_json().encode()
+
 # ---------------------------------------------------------------------------
 # API Endpoints
 # ---------------------------------------------------------------------------
@@ -118,20 +160,7 @@ class InvoiceResponse(BaseModel):
 @router.get("/prices", response_model=PricingResponse)
 async def get_prices():
     """Get current pricing for all materials"""
-    try:
-        return PricingResponse(
-            materials={
-                material: MaterialPrice(**details)
-                for material, details in GRILLZ_PRICES.items()
-            },
-            stripe_publishable_key=STRIPE_PUBLISHABLE_KEY
-        )
-    except Exception as e:
-        logger.error(f"Error getting prices: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to get pricing information"
-        )
+    return Response(content=PRICES_JSON, media_type="application/json")
 
 @router.post("/create-order", response_model=CreateOrderResponse)
 async def create_order(
@@ -141,7 +170,7 @@ async def create_order(
     db: AsyncSession = Depends(get_db)
 ):
     """Create a new order"""
-    logger.info(f"Creating order for user {current_user.id}: {order_data}")
+    logger.info("Creating order for user %s: %r", current_user.id, order_data)
     
     # Validate and calculate price
     total_price = 0
@@ -181,6 +210,35 @@ async def create_order(
     # Generate unique UUID for order
     order_uuid = str(uuid.uuid4())
     
+    # Create the Stripe Checkout Session first so the order is inserted with
+    # its session ID in a single commit, without holding a write transaction
+    # open across the Stripe call. The Stripe client is synchronous, so run it
+    # in a thread to keep the event loop free during the HTTPS round-trip.
+    product_data = CHECKOUT_PRODUCT_DATA.get((order_data.product_type, order_data.material))
+    if product_data is None:
+        product_data = build_checkout_product_data(order_data.product_type, order_data.material)
+    checkout_session = await asyncio.to_thread(
+        stripe.checkout.Session.create,
+        **CHECKOUT_SESSION_DEFAULTS,
+        line_items=[{
+            'price_data': {
+                'currency': 'usd',
+                'product_data': product_data,
+                'unit_amount': int(total_price * 100),  # Stripe expects cents
+            },
+            'quantity': 1,
+        }],
+        success_url=f"{request.base_url}invoice/success?session_id={{CHECKOUT_SESSION_ID}}",
+        cancel_url=f"{request.base_url}",
+        metadata={
+            'order_uuid': order_uuid,
+            'product_type': order_data.product_type,
+            'material': order_data.material,
+            'user_id': str(current_user.id),
+            'discount_type': discount_type or 'none'
+        }
+    )
+    
     # Create order
     order = Order(
         uuid=order_uuid,
@@ -197,44 +255,14 @@ async def create_order(
         shipping_address=order_data.shipping_address,
         shipping_city=order_data.shipping_city,
         shipping_zip_code=order_data.shipping_zip_code,
+        stripe_payment_intent=checkout_session.id,  # Store checkout session ID
         payment_status="pending"
     )
     
     db.add(order)
     await db.commit()
-    await db.refresh(order)
-    
-    # Create Stripe Checkout Session
-    checkout_session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        line_items=[{
-            'price_data': {
-                'currency': 'usd',
-                'product_data': {
-                    'name': f'{order_data.product_type.title()} - {order_data.material.title()}',
-                    'description': f'Custom {order_data.product_type} order',
-                },
-                'unit_amount': int(total_price * 100),  # Stripe expects cents
-            },
-            'quantity': 1,
-        }],
-        mode='payment',
-        success_url=f"{request.base_url}invoice/success?session_id={{CHECKOUT_SESSION_ID}}",
-        cancel_url=f"{request.base_url}",
-        metadata={
-            'order_uuid': order.uuid,
-            'product_type': order.product_type,
-            'material': order.material,
-            'user_id': str(current_user.id),
-            'discount_type': discount_type or 'none'
-        }
-    )
-    
-    # Store checkout session ID
-    order.stripe_payment_intent = checkout_session.id
-    await db.commit()
     
-    logger.info(f"Order and Stripe checkout session created: {order.uuid}")
+    logger.info("Order and Stripe checkout session created: %s", order.uuid)
     
     return CreateOrderResponse(
         success=True,
@@ -255,12 +283,11 @@ async def get_user_orders(
     """Get all orders for the current user"""
     try:
         result = await db.execute(
-            select(Order)
+            select(*ORDER_RESPONSE_COLUMNS)
             .where(Order.user_id == current_user.id)
             .order_by(Order.created_at.desc())
         )
-        orders = result.scalars().all()
-        return orders
+        return ORJSONResponse(content=[dict(row._mapping) for row in result])
         
     except Exception as e:
         logger.error(f"Error getting user orders: {str(e)}")
@@ -278,39 +305,49 @@ async def apply_referral_discount(db: AsyncSession, user_id: int, total_price: f
     discount_type = None
     
     try:
-        # Check for referee discount (10% off)
+        # Fetch unused referee discounts (user was referred) and unused referrer
+        # discounts (user's code was used) in one query
         result = await db.execute(
-            select(ReferralUse)
-            .where(ReferralUse.referred_user_id == user_id)
-            .where(ReferralUse.referee_discount_used == False)
+            select(ReferralUse, ReferralCode.user_id)
+            .join(ReferralCode, ReferralCode.id == ReferralUse.referral_code_id)
+            .where(
+                or_(
+                    and_(
+                        ReferralUse.referred_user_id == user_id,
+                        ReferralUse.referee_discount_used.is_(False)
+                    ),
+                    and_(
+                        ReferralCode.user_id == user_id,
+                        ReferralUse.referrer_discount_used.is_(False)
+                    )
+                )
+            )
+        )
+        candidates = result.all()
+        
+        # Referee discount (10% off) takes precedence over referrer discount (20% off)
+        referee_discount = next(
+            (use for use, _ in candidates
+             if use.referred_user_id == user_id and not use.referee_discount_used),
+            None
+        )
+        referrer_discount = next(
+            (use for use, owner_id in candidates
+             if owner_id == user_id and not use.referrer_discount_used),
+            None
         )
-        referee_discount = result.scalar_one_or_none()
         
         if referee_discount:
             total_price = total_price * 0.9  # 10% off
             referee_discount.referee_discount_used = True
             discount_type = "referee"
-        else:
-            # Check for referrer discount (20% off)
-            result = await db.execute(
-                select(ReferralCode).where(ReferralCode.user_id == user_id)
-            )
-            referral_code = result.scalar_one_or_none()
-            
-            if referral_code:
-                result = await db.execute(
-                    select(ReferralUse)
-                    .where(ReferralUse.referral_code_id == referral_code.id)
-                    .where(ReferralUse.referrer_discount_used == False)
-                )
-                referrer_discount = result.scalar_one_or_none()
-                
-                if referrer_discount:
-                    total_price = total_price * 0.8  # 20% off
-                    referrer_discount.referrer_discount_used = True
-                    discount_type = "referrer"
+        elif referrer_discount:
+            total_price = total_price * 0.8  # 20% off
+            referrer_discount.referrer_discount_used = True
+            discount_type = "referrer"
         
-        await db.commit()
+        # Not committed here: create_order persists the used discount and the
+        # new order together in its single commit
         
     except Exception as e:
         logger.error(f"Error applying referral discount: {str(e)}")
@@ -335,6 +372,11 @@ async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
         logger.error("STRIPE_WEBHOOK_SECRET not configured")
         raise HTTPException(status_code=500, detail="Webhook secret not configured")
     
+    # Reject unsigned requests before doing any HMAC work
+    if not sig_header or "v1=" not in sig_header:
+        logger.error("Missing or malformed Stripe signature header")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
     try:
         # Verify webhook signature
         event = stripe.Webhook.construct_event(
@@ -349,6 +391,11 @@ async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
         logger.error(f"Invalid signature: {e}")
         raise HTTPException(status_code=400, detail="Invalid signature")
     
+    if event['id'] in _processed_webhook_events:
+        logger.info("Duplicate webhook event %s ignored", event["id"])
+        return Response(content=WEBHOOK_DUPLICATE_JSON, media_type="application/json")
+    _processed_webhook_events[event['id']] = True
+    
     # Handle the checkout.session.completed event
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
@@ -374,34 +421,47 @@ async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
     else:
         logger.info(f"Unhandled event type: {event['type']}")
     
-    return JSONResponse(content={"status": "success"})
+    return Response(content=WEBHOOK_ACK_JSON, media_type="application/json")
 
 async def handle_successful_payment(db: AsyncSession, session):
     """Handle successful payment completion"""
     checkout_session_id = session['id']
     
-    # Find the order by checkout session ID
+    # Find the order by checkout session ID, together with the referral use
+    # record for the code its user registered with (if any)
     result = await db.execute(
-        select(Order).where(Order.stripe_payment_intent == checkout_session_id)
+        select(Order, ReferralUse)
+        .join(User, User.id == Order.user_id)
+        .outerjoin(ReferralCode, ReferralCode.code == User.referred_by)
+        .outerjoin(
+            ReferralUse,
+            and_(
+                ReferralUse.referral_code_id == ReferralCode.id,
+                ReferralUse.referred_user_id == Order.user_id
+            )
+        )
+        .where(Order.stripe_payment_intent == checkout_session_id)
     )
-    order = result.scalar_one_or_none()
+    row = result.first()
     
-    if not order:
+    if not row:
         logger.error(f"Order not found for checkout session: {checkout_session_id}")
         return
     
+    order, referral_use = row
+    
     if order.payment_status == 'paid':
         logger.info(f"Order {order.uuid} already marked as paid")
         return
     
     # Update order status to paid
     order.payment_status = 'paid'
-    order.updated_at = datetime.utcnow()
+    order.updated_at = datetime.now(timezone.utc)
     
     logger.info(f"Order {order.uuid} marked as paid")
     
     # Activate referral bonuses if this is the user's first paid order
-    await activate_referral_bonus(db, order.user_id, order.id)
+    activate_referral_bonus(referral_use, order)
     
     await db.commit()
     logger.info(f"Successfully processed payment for order {order.uuid}")
@@ -422,54 +482,21 @@ async def handle_failed_payment(db: AsyncSession, session):
     
     # Update order status to failed
     order.payment_status = 'failed'
-    order.updated_at = datetime.utcnow()
+    order.updated_at = datetime.now(timezone.utc)
     
     await db.commit()
     logger.info(f"Order {order.uuid} marked as failed")
 
-async def activate_referral_bonus(db: AsyncSession, user_id: int, order_id: int):
+def activate_referral_bonus(referral_use: Optional[ReferralUse], order: Order):
     """Activate referral bonuses when user completes their first order"""
-    try:
-        # Check if this user was referred by someone
-        user_result = await db.execute(select(User).where(User.id == user_id))
-        user = user_result.scalar_one_or_none()
-        
-        if not user or not user.referred_by:
-            return  # User wasn't referred
-        
-        # Find the referral use record
-        referral_code_result = await db.execute(
-            select(ReferralCode).where(ReferralCode.code == user.referred_by)
-        )
-        referral_code = referral_code_result.scalar_one_or_none()
-        
-        if not referral_code:
-            logger.warning(f"Referral code {user.referred_by} not found")
-            return
-        
-        referral_use_result = await db.execute(
-            select(ReferralUse).where(
-                ReferralUse.referral_code_id == referral_code.id,
-                ReferralUse.referred_user_id == user_id
-            )
-        )
-        referral_use = referral_use_result.scalar_one_or_none()
-        
-        if not referral_use:
-            logger.warning(f"Referral use record not found for user {user_id}")
-            return
-        
-        if referral_use.is_active:
-            logger.info(f"Referral bonus already activated for user {user_id}")
-            return
-        
-        # Activate the referral bonus
-        referral_use.is_active = True
-        referral_use.first_order_id = order_id
-        
-        await db.commit()
-        logger.info(f"Activated referral bonus for user {user_id}, referrer gets commission")
-        
-    except Exception as e:
-        logger.error(f"Error activating referral bonus: {str(e)}")
-        await db.rollback()
\ No newline at end of file
+    if not referral_use:
+        return  # User wasn't referred
+    
+    if referral_use.is_active:
+        logger.info(f"Referral bonus already activated for user {order.user_id}")
+        return
+    
+    # Activate the referral bonus; committed together with the order update
+    referral_use.is_active = True
+    referral_use.first_order_id = order.id
+    logger.info(f"Activated referral bonus for user {order.user_id}, referrer gets commission")
\ No newline at end of file
@@ -1,66 +1,101 @@
 from fastapi import APIRouter, Request, Depends, HTTPException, status, Query, Path
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select, insert, func, case, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 import re
-import html
-import bleach
-import secrets
-import string
+import hashlib
+import os
+import base64
 import logging
 
 from models import User, Invoice, Order, ReferralCode, ReferralUse
-from auth import get_optional_current_user, get_current_user
+from auth import get_optional_current_user, get_current_user, require_active_user_or_redirect
 from database import get_db
+from templating import templates
+from routes.referrals import get_referral_code_for_user
 
 router = APIRouter(tags=["pages"])
-templates = Jinja2Templates(directory="templates")
 logger = logging.getLogger(__name__)
 
-def sanitize_string(value: str) -> str:
-    """Sanitize string input to prevent XSS and injection attacks"""
-    if not value:
-        return ""
-    # Remove HTML tags and strip whitespace
-    sanitized = bleach.clean(value.strip(), tags=[], strip=True)
-    # Escape HTML entities
-    sanitized = html.escape(sanitized)
-    return sanitized
+ORDERS_PAGE_SIZE = 50
+
+# Only the columns orders.html reads; rows are rendered as named tuples
+ORDERS_PAGE_COLUMNS = (
+    Order.uuid,
+    Order.product_type,
+    Order.material,
+    Order.teeth_selection,
+    Order.product_details,
+    Order.total_price,
+    Order.payment_status,
+    Order.created_at,
+    Order.shipping_full_name,
+    Order.shipping_address,
+    Order.shipping_city,
+    Order.shipping_zip_code,
+)
+
+# Matched with fullmatch() so a trailing newline cannot slip past a `$`;
+# the route parameters anchor the same pattern for pydantic's regex engine
+_REFERRAL_RE = re.compile(r'[A-Za-z0-9-]{1,50}')
+_REFERRAL_PATTERN = f"^{_REFERRAL_RE.pattern}$"
+
+# Referrers earn 20% of each referred user's first paid order; evaluated
+# in SQL so neither the per-row reward nor the total is computed in Python
+REFERRAL_REWARD = case(
+    (and_(ReferralUse.is_active.is_(True), Order.total_price.isnot(None)), Order.total_price * 0.20),
+    else_=0.0
+)
 
 def validate_referral_code(code: str) -> str:
-    """Validate and sanitize referral code"""
+    """Validate referral code"""
+    code = code.strip() if code else ""
     if not code:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Referral code cannot be empty"
         )
     
-    # Sanitize the code
-    sanitized = sanitize_string(code)
-    
-    # Check length limits
-    if len(sanitized) > 50:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Referral code too long"
-        )
-    
-    # Only allow alphanumeric characters and hyphens
-    if not re.match(r'^[a-zA-Z0-9\-]+$', sanitized):
+    # Only alphanumeric characters and hyphens are allowed, none of which
+    # are HTML-special, so no further sanitization is needed
+    if not _REFERRAL_RE.fullmatch(code):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid referral code format"
+            detail="Referral code too long" if len(code) > 50 else "Invalid referral code format"
         )
     
-    return sanitized
+    return code
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header the way StaticFiles.is_not_modified does"""
+    if not if_none_match:
+        return False
+    # Weak comparison: proxies that gzip the body send back W/"..." tags
+    return etag in [tag.strip(" W/") for tag in if_none_match.split(",")]
+
+def render_public_page(request: Request, name: str, context: dict) -> Response:
+    """Render a page for an anonymous visitor with a shared-cacheable ETag"""
+    # The ETag hashes the rendered body, so a 304 saves bandwidth and
+    # client work, not the render itself
+    response = templates.TemplateResponse(name, {"request": request, **context})
+    etag = f'"{hashlib.blake2b(response.body, digest_size=16).hexdigest()}"'
+    headers = {
+        "Cache-Control": "public, max-age=300",
+        "ETag": etag,
+        # The same URL renders differently once the auth cookie is set
+        "Vary": "Cookie",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return response
 
 def generate_secure_referral_code(length: int = 8) -> str:
     """Generate a cryptographically secure referral code"""
-    alphabet = string.ascii_uppercase + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    # Base32 of random bytes gives 5 bits per uppercase A-Z/2-7 character
+    return base64.b32encode(os.urandom((length * 5 + 7) // 8))[:length].decode("ascii")
 
 @router.get("/", response_class=HTMLResponse)
 async def home(
@@ -68,10 +103,14 @@ async def home(
     current_user: Optional[User] = Depends(get_optional_current_user)
 ):
     try:
-        return templates.TemplateResponse(
+        if current_user is None:
+            return render_public_page(request, "landing.html", {"user": None})
+        response = templates.TemplateResponse(
             "landing.html",
             {"request": request, "user": current_user}
         )
+        response.headers["Cache-Control"] = "private, no-store"
+        return response
     except Exception as e:
         logger.error(f"Error rendering home page: {str(e)}")
         raise HTTPException(
@@ -82,18 +121,9 @@ async def home(
 @router.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_page(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user)
+    current_user: User = Depends(require_active_user_or_redirect)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            logger.warning(f"Inactive user trying to access dashboard: {current_user.email[:5]}***")
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
         return templates.TemplateResponse(
             "dashboard.html",
             {"request": request, "user": current_user}
@@ -108,17 +138,9 @@ async def dashboard_page(
 @router.get("/studio", response_class=HTMLResponse)
 async def studio_page(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user)
+    current_user: User = Depends(require_active_user_or_redirect)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
         return templates.TemplateResponse(
             "order/create.html",
             {"request": request, "user": current_user}
@@ -133,17 +155,9 @@ async def studio_page(
 @router.get("/checkout", response_class=HTMLResponse)
 async def checkout_page(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user)
+    current_user: User = Depends(require_active_user_or_redirect)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
         return templates.TemplateResponse(
             "checkout.html",
             {"request": request, "user": current_user}
@@ -158,17 +172,9 @@ async def checkout_page(
 @router.get("/invoice/success", response_class=HTMLResponse)
 async def invoice_success_page(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user)
+    current_user: User = Depends(require_active_user_or_redirect)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-        
         return templates.TemplateResponse(
             "invoice/success.html",
             {"request": request, "user": current_user}
@@ -182,7 +188,7 @@ async def invoice_success_page(
 
 @router.get("/ref/{referral_code}")
 async def referral_redirect(
-    referral_code: str = Path(..., max_length=50, regex=r'^[a-zA-Z0-9\-]+$'),
+    referral_code: str = Path(..., max_length=50, pattern=_REFERRAL_PATTERN),
     db: AsyncSession = Depends(get_db)
 ):
     """Redirect referral links to registration with pre-filled code"""
@@ -228,10 +234,7 @@ async def login_page(
     try:
         if current_user:
             return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
-        return templates.TemplateResponse(
-            "auth/login.html",
-            {"request": request, "user": None}
-        )
+        return render_public_page(request, "auth/login.html", {"user": None})
     except Exception as e:
         logger.error(f"Error rendering login page: {str(e)}")
         raise HTTPException(
@@ -249,18 +252,16 @@ async def register_page(
         if current_user:
             return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
         
-        # Sanitize referral code if provided
-        sanitized_ref = None
-        if ref:
-            try:
-                sanitized_ref = validate_referral_code(ref)
-            except HTTPException:
-                # Invalid referral code - ignore it
-                sanitized_ref = None
+        # Invalid referral codes are ignored; matching directly avoids
+        # raising and catching an HTTPException for a bad query string
+        sanitized_ref = ref.strip() if ref else None
+        if sanitized_ref and not _REFERRAL_RE.fullmatch(sanitized_ref):
+            sanitized_ref = None
         
-        return templates.TemplateResponse(
+        return render_public_page(
+            request,
             "auth/register.html",
-            {"request": request, "user": None, "referral_code": sanitized_ref}
+            {"user": None, "referral_code": sanitized_ref}
         )
     except Exception as e:
         logger.error(f"Error rendering register page: {str(e)}")
@@ -272,24 +273,13 @@ async def register_page(
 @router.get("/referrals", response_class=HTMLResponse)
 async def referral_dashboard(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user),
+    current_user: User = Depends(require_active_user_or_redirect),
     db: AsyncSession = Depends(get_db)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
         # Get user's referral code with error handling
         try:
-            referral_code_result = await db.execute(
-                select(ReferralCode).where(ReferralCode.user_id == current_user.id)
-            )
-            user_referral_code = referral_code_result.scalar_one_or_none()
+            user_referral_code = await get_referral_code_for_user(db, current_user.id)
         except SQLAlchemyError as e:
             logger.error(f"Database error fetching referral code: {str(e)}")
             raise HTTPException(
@@ -300,11 +290,22 @@ async def referral_dashboard(
         # If user doesn't have a referral code, create one with secure generation
         if not user_referral_code:
             try:
-                code = generate_secure_referral_code(8)
-                user_referral_code = ReferralCode(user_id=current_user.id, code=code)
-                db.add(user_referral_code)
-                await db.commit()
-                await db.refresh(user_referral_code)
+                # Insert and read back the new row in one statement; retry
+                # once with a fresh code if it collides with an existing one
+                for attempt in range(2):
+                    try:
+                        result = await db.execute(
+                            insert(ReferralCode)
+                            .values(user_id=current_user.id, code=generate_secure_referral_code(8))
+                            .returning(ReferralCode.id, ReferralCode.code)
+                        )
+                        user_referral_code = tuple(result.one())
+                        await db.commit()
+                        break
+                    except IntegrityError:
+                        await db.rollback()
+                        if attempt:
+                            raise
             except SQLAlchemyError as e:
                 logger.error(f"Database error creating referral code: {str(e)}")
                 raise HTTPException(
@@ -312,58 +313,72 @@ async def referral_dashboard(
                     detail="Error creating referral code"
                 )
         
-        # Get referral stats with user details with error handling
+        code_id, code = user_referral_code
+        
+        # Get referral details and totals for the user's code. These run one
+        # after another on the request session: gathering them over extra
+        # pooled sessions would hold several connections per request for
+        # sub-millisecond SQLite reads
         try:
-            referral_uses_result = await db.execute(
-                select(ReferralUse, User)
+            result = await db.execute(
+                select(
+                    User.email,
+                    User.full_name,
+                    ReferralUse.used_at,
+                    ReferralUse.is_active,
+                    REFERRAL_REWARD.label("reward")
+                )
+                .select_from(ReferralUse)
                 .join(User, ReferralUse.referred_user_id == User.id)
-                .where(ReferralUse.referral_code_id == user_referral_code.id)
+                .outerjoin(Order, Order.id == ReferralUse.first_order_id)
+                .where(ReferralUse.referral_code_id == code_id)
                 .order_by(ReferralUse.used_at.desc())
             )
-            referral_data = referral_uses_result.all()
+            referral_data = result.all()
         except SQLAlchemyError as e:
             logger.error(f"Database error fetching referral uses: {str(e)}")
             referral_data = []
         
-        referral_uses = [ru for ru, user in referral_data]
+        try:
+            result = await db.execute(
+                select(
+                    func.count().label("total"),
+                    func.coalesce(func.sum(
+                        case((ReferralUse.is_active.is_(True), 1), else_=0)
+                    ), 0).label("active"),
+                    func.coalesce(func.sum(REFERRAL_REWARD), 0.0).label("earnings")
+                )
+                .select_from(ReferralUse)
+                .outerjoin(Order, Order.id == ReferralUse.first_order_id)
+                .where(ReferralUse.referral_code_id == code_id)
+            )
+            totals = result.one()
+            referral_totals = (totals.total, totals.active, float(totals.earnings))
+        except SQLAlchemyError as e:
+            logger.error(f"Database error calculating referral earnings: {str(e)}")
+            referral_totals = (0, 0, 0.0)
         
-        # Calculate stats with error handling
-        total_referrals = len(referral_uses)
-        active_referrals = len([r for r in referral_uses if r.is_active])
+        # Counts and earnings come from the SQL aggregate
+        total_referrals, active_referrals, total_earnings = referral_totals
         pending_referrals = total_referrals - active_referrals
         
-        # Calculate earnings and prepare detailed referral data
-        total_earnings = 0.0
-        detailed_referrals = []
-        
-        for referral_use, referred_user in referral_data:
-            reward = 0.0
-            if referral_use.is_active and referral_use.first_order_id:
-                try:
-                    # Get the order to calculate 20% of its value
-                    order_result = await db.execute(
-                        select(Order).where(Order.id == referral_use.first_order_id)
-                    )
-                    order = order_result.scalar_one_or_none()
-                    if order and order.total_price:
-                        reward = float(order.total_price) * 0.20  # 20% commission
-                        total_earnings += reward
-                except (SQLAlchemyError, ValueError, TypeError) as e:
-                    logger.error(f"Error calculating referral reward: {str(e)}")
-                    reward = 0.0
-            
-            detailed_referrals.append({
-                'user': referred_user,
-                'referral_use': referral_use,
-                'reward': reward
-            })
+        detailed_referrals = [
+            {
+                'email': referral.email,
+                'full_name': referral.full_name,
+                'used_at': referral.used_at,
+                'is_active': referral.is_active,
+                'reward': float(referral.reward)
+            }
+            for referral in referral_data
+        ]
         
         return templates.TemplateResponse(
             "referrals.html",
             {
                 "request": request, 
                 "user": current_user,
-                "referral_code": user_referral_code.code,
+                "referral_code": code,
                 "total_referrals": total_referrals,
                 "active_referrals": active_referrals,
                 "pending_referrals": pending_referrals,
@@ -385,62 +400,56 @@ async def referral_dashboard(
 @router.get("/orders", response_class=HTMLResponse)
 async def orders_page(
     request: Request,
-    current_user: Optional[User] = Depends(get_optional_current_user),
+    current_user: User = Depends(require_active_user_or_redirect),
+    page: int = Query(1, ge=1),
     db: AsyncSession = Depends(get_db)
 ):
     try:
-        # Redirect unauthenticated users to login page
-        if current_user is None:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        # Check if user is active
-        if hasattr(current_user, 'is_active') and not current_user.is_active:
-            return RedirectResponse(url="/auth/login", status_code=status.HTTP_303_SEE_OTHER)
+        # Fetch one page of orders and the stats over all of the user's orders
+        orders_query = (
+            select(*ORDERS_PAGE_COLUMNS)
+            .where(Order.user_id == current_user.id)
+            .order_by(Order.created_at.desc())
+            .offset((page - 1) * ORDERS_PAGE_SIZE)
+            .limit(ORDERS_PAGE_SIZE + 1)
+        )
+        stats_query = select(
+            func.count().label("total"),
+            func.coalesce(func.sum(case((Order.payment_status == 'pending', 1), else_=0)), 0).label("pending"),
+            func.coalesce(func.sum(case((Order.payment_status == 'paid', 1), else_=0)), 0).label("paid"),
+            func.coalesce(func.sum(case((Order.payment_status == 'shipped', 1), else_=0)), 0).label("shipped"),
+            func.coalesce(func.sum(case(
+                (Order.payment_status.in_(['paid', 'shipped']), Order.total_price), else_=0
+            )), 0).label("spent")
+        ).where(Order.user_id == current_user.id)
 
-        # Get all orders for the current user with error handling
         try:
-            result = await db.execute(
-                select(Order)
-                .where(Order.user_id == current_user.id)
-                .order_by(Order.created_at.desc())
-            )
-            orders = result.scalars().all()
+            orders = (await db.execute(orders_query)).all()
+            stats = (await db.execute(stats_query)).one()
         except SQLAlchemyError as e:
             logger.error(f"Database error fetching orders: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Error loading orders"
             )
-        
-        # Calculate stats with error handling
-        try:
-            total_orders = len(orders)
-            pending_orders = len([o for o in orders if o.payment_status == 'pending'])
-            completed_orders = len([o for o in orders if o.payment_status == 'paid'])
-            shipped_orders = len([o for o in orders if o.payment_status == 'shipped'])
-            
-            # Calculate total spent with proper error handling
-            total_spent = 0.0
-            for order in orders:
-                if order.payment_status in ['paid', 'shipped'] and order.total_price:
-                    try:
-                        total_spent += float(order.total_price)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid total_price for order {order.id}")
-                        continue
-                        
-        except Exception as e:
-            logger.error(f"Error calculating order stats: {str(e)}")
-            # Set default values on error
-            total_orders = pending_orders = completed_orders = shipped_orders = 0
-            total_spent = 0.0
+
+        has_next_page = len(orders) > ORDERS_PAGE_SIZE
+        orders = orders[:ORDERS_PAGE_SIZE]
+
+        total_orders = stats.total
+        pending_orders = stats.pending
+        completed_orders = stats.paid
+        shipped_orders = stats.shipped
+        total_spent = float(stats.spent)
         
         return templates.TemplateResponse(
             "orders.html",
             {
                 "request": request, 
                 "user": current_user,
-                "orders": orders or [],
+                "orders": orders,
+                "page": page,
+                "has_next_page": has_next_page,
                 "total_orders": total_orders,
                 "pending_orders": pending_orders,
                 "completed_orders": completed_orders,
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from typing import List
+from sqlalchemy import select, func, case, and_, exists
+from typing import List, Optional, Tuple
 from pydantic import BaseModel
 from datetime import datetime
+from cachetools import TTLCache
 
 from database import get_db
 from models import User, ReferralCode, ReferralUse
@@ -11,6 +12,25 @@ from auth import get_current_user
 
 router = APIRouter(prefix="/referrals", tags=["referrals"])
 
+# A user's referral code never changes once created, so (id, code) pairs are
+# kept in memory; users without a code are not cached
+_referral_code_cache = TTLCache(maxsize=10000, ttl=300)
+
+async def get_referral_code_for_user(db: AsyncSession, user_id: int) -> Optional[Tuple[int, str]]:
+    """Return the (id, code) of the user's referral code, or None"""
+    cached = _referral_code_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    result = await db.execute(
+        select(ReferralCode.id, ReferralCode.code).where(ReferralCode.user_id == user_id)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    _referral_code_cache[user_id] = (row.id, row.code)
+    return row.id, row.code
+
 class ReferralStats(BaseModel):
     code: str
     total_referrals: int
@@ -29,35 +49,37 @@ async def get_referral_stats(
     db: AsyncSession = Depends(get_db)
 ):
     # Get user's referral code
-    result = await db.execute(
-        select(ReferralCode).where(ReferralCode.user_id == current_user.id)
-    )
-    referral_code = result.scalar_one_or_none()
+    referral_code = await get_referral_code_for_user(db, current_user.id)
     if not referral_code:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No referral code found"
         )
+    code_id, code = referral_code
 
-    # Get referral statistics
+    # Get referral statistics in a single pass over the code's uses
     result = await db.execute(
         select(
-            func.count(ReferralUse.id).label("total"),
-            func.count(ReferralUse.id).filter(ReferralUse.is_active == True).label("active"),
-            func.count(ReferralUse.id).filter(
-                ReferralUse.is_active == True,
-                ReferralUse.referrer_discount_used == False
-            ).label("available")
-        ).where(ReferralUse.referral_code_id == referral_code.id)
+            func.count().label("total"),
+            func.coalesce(func.sum(
+                case((ReferralUse.is_active.is_(True), 1), else_=0)
+            ), 0).label("active"),
+            func.coalesce(func.sum(
+                case((and_(
+                    ReferralUse.is_active.is_(True),
+                    ReferralUse.referrer_discount_used.is_(False)
+                ), 1), else_=0)
+            ), 0).label("available")
+        ).where(ReferralUse.referral_code_id == code_id)
     )
-    stats = result.first()
+    stats = result.one()
     
     return ReferralStats(
-        code=referral_code.code,
-        total_referrals=stats[0] or 0,
-        successful_referrals=stats[1] or 0,
-        available_discounts=stats[2] or 0,
-        referral_url=f"/register?ref={referral_code.code}"
+        code=code,
+        total_referrals=stats.total,
+        successful_referrals=stats.active,
+        available_discounts=stats.available,
+        referral_url=f"/register?ref={code}"
     )
 
 @router.get("/history", response_model=List[ReferralHistory])
@@ -66,32 +88,31 @@ async def get_referral_history(
     db: AsyncSession = Depends(get_db)
 ):
     # Get user's referral code
-    result = await db.execute(
-        select(ReferralCode).where(ReferralCode.user_id == current_user.id)
-    )
-    referral_code = result.scalar_one_or_none()
+    referral_code = await get_referral_code_for_user(db, current_user.id)
     if not referral_code:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No referral code found"
         )
+    code_id, _ = referral_code
 
     # Get referral history with referred user details
     result = await db.execute(
-        select(ReferralUse, User)
+        select(User.email, ReferralUse.used_at, ReferralUse.referrer_discount_used)
+        .select_from(ReferralUse)
         .join(User, ReferralUse.referred_user_id == User.id)
-        .where(ReferralUse.referral_code_id == referral_code.id)
+        .where(ReferralUse.referral_code_id == code_id)
         .order_by(ReferralUse.used_at.desc())
     )
     history = result.all()
 
     return [
         ReferralHistory(
-            referred_user_email=user.email,
-            used_at=use.used_at,
-            discount_used=use.referrer_discount_used
+            referred_user_email=email,
+            used_at=used_at,
+            discount_used=discount_used
         )
-        for use, user in history
+        for email, used_at, discount_used in history
     ]
 
 @router.get("/check-discount")
@@ -99,30 +120,26 @@ async def check_available_discount(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    # Check if user has an unused referee discount
+    # Check for an unused referee discount and unused referrer discounts
+    # from successful referrals in a single round trip
     result = await db.execute(
-        select(ReferralUse)
-        .where(ReferralUse.referred_user_id == current_user.id)
-        .where(ReferralUse.referee_discount_used == False)
+        select(
+            exists().where(
+                ReferralUse.referred_user_id == current_user.id,
+                ReferralUse.referee_discount_used.is_(False)
+            ).label("referee"),
+            exists().where(
+                ReferralCode.id == ReferralUse.referral_code_id,
+                ReferralCode.user_id == current_user.id,
+                ReferralUse.referrer_discount_used.is_(False),
+                ReferralUse.is_active.is_(True)  # Only count active referrals
+            ).label("referrer")
+        )
     )
-    referee_discount = result.scalar_one_or_none()
-    if referee_discount:
+    available = result.one()
+    if available.referee:
         return {"discount": 0.10, "type": "referee"}  # 10% discount
-
-    # Check if user has unused referrer discounts from successful referrals
-    result = await db.execute(
-        select(ReferralCode).where(ReferralCode.user_id == current_user.id)
-    )
-    referral_code = result.scalar_one_or_none()
-    if referral_code:
-        result = await db.execute(
-            select(ReferralUse)
-            .where(ReferralUse.referral_code_id == referral_code.id)
-            .where(ReferralUse.referrer_discount_used == False)
-            .where(ReferralUse.is_active == True)  # Only count active referrals
-        )
-        referrer_discount = result.scalar_one_or_none()
-        if referrer_discount:
-            return {"discount": 0.20, "type": "referrer"}  # 20% discount
+    if available.referrer:
+        return {"discount": 0.20, "type": "referrer"}  # 20% discount
 
     return {"discount": 0, "type": None} 
\ No newline at end of file
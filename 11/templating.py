@@ -0,0 +1,27 @@
+import os
+
+import jinja2
+from fastapi.templating import Jinja2Templates
+
+# Optional shared location for compiled template bytecode. When unset, Jinja
+# uses its default per-user temp directory, which it creates with 0o700
+# and checks for ownership before loading cached code from it
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")
+
+# Shared templates instance so every router renders from one Jinja
+# environment and one compiled-template cache
+templates = Jinja2Templates(
+    env=jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"),
+        autoescape=jinja2.select_autoescape(),
+        auto_reload=False,
+        cache_size=400,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(directory=JINJA_CACHE_DIR),
+    )
+)
+
+
+def warm_templates() -> None:
+    """Compile every template into the environment cache ahead of the first request."""
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.env.get_template(name)